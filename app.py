@@ -6,13 +6,26 @@ Optimized for Render.com deployment with CPU-based processing
 import os
 import io
 import gc
+import hashlib
+import math
 import logging
+import threading
+import time
+import warnings
+import zipfile
+from collections import OrderedDict
 from datetime import datetime
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, request, jsonify
 from flask_cors import CORS
-from PIL import Image
-from rembg import remove, new_session
-from werkzeug.utils import secure_filename
+import numpy as np
+import onnxruntime as ort
+from PIL import Image, ImageOps
+from rembg import new_session
+from werkzeug.exceptions import HTTPException
+
+import mask_postprocess
+from mask_postprocess import open_and_smooth
+from ort_session import MicroBatcher, ORTSession
 
 # Configure logging
 logging.basicConfig(
@@ -35,40 +48,391 @@ CORS(app, resources={
 
 # Configuration
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB (reduced for 512MB RAM limit)
+# Reject oversized bodies while parsing (413), with headroom for the multipart framing
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + 64 * 1024
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
+MAX_INFERENCE_DIMENSION = 1024  # ISNet input size, larger uploads are downscaled first
+MAX_DIMENSION = 2048  # Cap for full=1 results (to save memory during processing)
+CUTOUT_BLOCK_ROWS = 256  # Rows blended at a time, bounds cutout's temporaries
+
+# Reject decompression bombs up front: anything over 40MP is far beyond what
+# a 5MB upload should decode to, treat Pillow's warning as a hard error too
+Image.MAX_IMAGE_PIXELS = 1024 * 1024 * 40
+warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+# Micro-batching of concurrent inferences (see ort_session.MicroBatcher).
+# Off by default: each extra image in a batch needs another activation arena,
+# too much for the 512MB free tier, and batching adds the wait window to lone
+# requests. Raise BATCH_SIZE on larger plans
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 1))
+BATCH_WINDOW = float(os.environ.get('BATCH_WINDOW_MS', 20)) / 1000
+# Images per /api/remove-bg-batch request. Independent of BATCH_SIZE: with a
+# batch size of 1 the files simply run one after another
+MAX_BATCH_FILES = int(os.environ.get('MAX_BATCH_FILES', 4))
+
+# Model files produced by build_model.py, in order of preference. The
+# *.opt.onnx variants are already partly graph-optimized offline. FP16 is never
+# picked automatically (on x86 CPUs most FP16 nodes run through inserted
+# Casts and are usually slower); select it with ISNET_MODEL
+MODEL_DIR = os.environ.get('MODEL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'))
+MODEL_CANDIDATES = [
+    'isnet_int8.opt.onnx', 'isnet_int8.onnx',
+    'isnet.opt.onnx', 'isnet.onnx',
+]
+
+# Per-thread encode buffers, reused across requests instead of reallocated.
+# Only pooled up to inference-sized results
+_io_buffers = threading.local()
+MAX_POOLED_BUFFER = MAX_INFERENCE_DIMENSION * MAX_INFERENCE_DIMENSION * 4
+
+# LRU cache of encoded results keyed by upload content hash, so resubmitted
+# images (retries, duplicate tabs) skip inference. Bounded by entry count and
+# total bytes to stay within the free tier's memory
+RESPONSE_CACHE_ENTRIES = int(os.environ.get('RESPONSE_CACHE_ENTRIES', 128))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+_response_cache = OrderedDict()
+_response_cache_bytes = 0
+_response_cache_lock = threading.Lock()
 
 # Global session - Initialize once and reuse for all requests
 # This significantly improves performance by keeping the model in memory
 rembg_session = None
-_model_loading = False
+# Serializes model initialization across gthread worker threads; inference
+# itself needs no lock since InferenceSession.run is thread-safe
+_model_lock = threading.Lock()
+
+def find_model_path():
+    """Return the preferred exported ONNX model, or None if none was built"""
+    # Explicit choice, e.g. ISNET_MODEL=isnet_fp16.opt.onnx if INT8 is too lossy
+    override = os.environ.get('ISNET_MODEL')
+    if override:
+        return os.path.join(MODEL_DIR, override)
+    for name in MODEL_CANDIDATES:
+        path = os.path.join(MODEL_DIR, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+def available_cpus():
+    """
+    Number of CPUs this container may actually use
+    Honors the affinity mask and, where present, the cgroup CPU quota
+    """
+    try:
+        ncpu = len(os.sched_getaffinity(0))
+    except AttributeError:
+        ncpu = os.cpu_count() or 1
+    
+    # cgroup v2 exposes "<quota> <period>", cgroup v1 splits them in two files
+    quota = period = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = f.read().strip()
+        except OSError:
+            pass
+    
+    if quota not in (None, 'max', '-1') and period:
+        ncpu = min(ncpu, max(1, math.ceil(int(quota) / int(period))))
+    return ncpu
+
+def build_session_options():
+    """ONNX Runtime options sized to the container's CPU budget"""
+    ncpu = available_cpus()
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = ncpu
+    sess_options.inter_op_num_threads = 1
+    sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    # *.opt.onnx files already carry the extended fusions from build_model.py;
+    # ENABLE_ALL still applies the CPU-specific layout optimizations on load
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # Spinning idle workers starve request threads on shared/burst CPUs
+    sess_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+    logger.info(f"ONNX Runtime intra-op threads: {ncpu}")
+    return sess_options
+
+def warm_up_model(session):
+    """
+    Run one synthetic inference so the first real request does not pay for
+    kernel selection and memory arena growth
+    """
+    start = time.perf_counter()
+    # Content does not matter (preprocess guards the divide by the maximum),
+    # only the full model input size does
+    dummy = np.zeros((MAX_INFERENCE_DIMENSION, MAX_INFERENCE_DIMENSION, 3), dtype=np.uint8)
+    process(dummy, session)
+    logger.info(f"Model warmed up in {time.perf_counter() - start:.2f}s")
 
 def init_model():
     """Initialize rembg model on startup"""
-    global rembg_session, _model_loading
+    global rembg_session
     
     if rembg_session is not None:
         return  # Already initialized
     
-    if _model_loading:
-        return  # Already loading
-    
-    _model_loading = True
-    try:
-        logger.info("Initializing rembg model (isnet-general-use)...")
-        rembg_session = new_session("isnet-general-use")
-        logger.info("Model initialized successfully!")
-    except Exception as e:
-        logger.error(f"Failed to initialize model: {str(e)}")
-        _model_loading = False
-        raise
-    finally:
-        _model_loading = False
+    with _model_lock:
+        if rembg_session is not None:
+            return  # Initialized by another thread while we waited
+        
+        try:
+            # Keep the Numba mask kernels within the container's CPU budget
+            mask_postprocess.set_threads(available_cpus())
+            
+            model_path = find_model_path()
+            if model_path is None:
+                # No exported model (build_model.py not run), use rembg's download
+                logger.warning("No exported ONNX model found, falling back to rembg isnet-general-use")
+                session = new_session("isnet-general-use")
+            else:
+                logger.info(f"Initializing ONNX Runtime session ({model_path})...")
+                session = MicroBatcher(
+                    ORTSession(model_path, build_session_options()),
+                    max_batch_size=BATCH_SIZE,
+                    max_wait=BATCH_WINDOW
+                )
+            
+            # Only publish the session once it has produced a result
+            try:
+                warm_up_model(session)
+            except Exception:
+                if hasattr(session, 'close'):
+                    session.close()
+                raise
+            rembg_session = session
+            logger.info("Model initialized successfully!")
+        except Exception as e:
+            logger.error(f"Failed to initialize model: {str(e)}")
+            raise
 
 def ensure_model_loaded():
     """Ensure model is loaded, initialize if needed"""
-    if rembg_session is None and not _model_loading:
+    if rembg_session is None:
         init_model()
 
+def get_buffer(size):
+    """
+    Per-thread BytesIO reused for encoding, rewound and grown to size bytes
+    It is deliberately not truncated: truncating frees the backing storage,
+    which would defeat the reuse. Callers take the written length from tell()
+    """
+    buffer = getattr(_io_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _io_buffers.buffer = io.BytesIO()
+    if buffer.seek(0, io.SEEK_END) < size:
+        buffer.seek(size - 1)
+        buffer.write(b'\0')
+    buffer.seek(0)
+    return buffer
+
+def write_png(buffer, array):
+    """Encode array into buffer from its current position, returning the bytes"""
+    Image.fromarray(array).save(buffer, format='PNG', compress_level=1, optimize=False)
+    size = buffer.tell()
+    with buffer.getbuffer() as view:
+        return bytes(view[:size])
+
+def encode_png(array):
+    """
+    Encode an RGBA array as PNG with fast zlib settings
+    Small results reuse a per-thread buffer pre-sized to the raw pixel size,
+    so the encoder never regrows it
+    """
+    height, width = array.shape[:2]
+    size = width * height * 4
+    if size > MAX_POOLED_BUFFER:
+        # Full-resolution results: don't pin a huge buffer to the thread, and
+        # don't pre-size it either (a zeroed bytearray that BytesIO then copies)
+        with io.BytesIO() as buffer:
+            return write_png(buffer, array)
+    return write_png(get_buffer(size), array)
+
+def cutout(pixels, mask):
+    """
+    Composite RGB/RGBA pixels over transparency using mask as alpha
+    Same integer blend as rembg's naive_cutout, done on arrays: every
+    channel, including an existing alpha channel, is scaled by the mask.
+    Blends into the output array block by block so temporaries stay small
+    """
+    height, width = mask.shape
+    output = np.empty((height, width, 4), dtype=np.uint8)
+    output[:, :, :3] = pixels[:, :, :3]
+    output[:, :, 3] = mask
+    
+    for start in range(0, height, CUTOUT_BLOCK_ROWS):
+        block = output[start:start + CUTOUT_BLOCK_ROWS]
+        alpha = block[:, :, 3:].astype(np.uint16)
+        blended = block[:, :, :3] * alpha
+        blended += 127
+        blended //= 255
+        block[:, :, :3] = blended
+        if pixels.shape[2] == 4:
+            # Keep pixels that were already transparent in the upload transparent
+            alpha *= pixels[start:start + CUTOUT_BLOCK_ROWS, :, 3:]
+            alpha += 127
+            alpha //= 255
+            block[:, :, 3:] = alpha
+    return output
+
+def process_many(input_arrays, session=None):
+    """
+    Remove the background from RGB/RGBA arrays, returning RGBA arrays
+    Calls the session directly instead of rembg's remove(), which would
+    re-wrap and re-convert the pixels, and cleans the masks with the Numba
+    kernels in mask_postprocess. Batching sessions run all images together
+    """
+    session = session or rembg_session
+    imgs = [Image.fromarray(input_array) for input_array in input_arrays]
+    if hasattr(session, 'predict_many'):
+        masks = session.predict_many(imgs)
+    else:
+        masks = [session.predict(img)[0] for img in imgs]
+    for img in imgs:
+        img.close()
+    
+    outputs = []
+    for input_array, mask in zip(input_arrays, masks):
+        mask = np.array(mask)
+        open_and_smooth(mask, radius=2)  # Improves edge quality
+        outputs.append(cutout(input_array, mask))
+    return outputs
+
+def process(input_array, session=None):
+    """Remove the background from a single RGB/RGBA array"""
+    return process_many([input_array], session)[0]
+
+def restore_full_resolution(original, output_array):
+    """Upscale the predicted alpha channel and apply it to the original image"""
+    alpha = Image.fromarray(output_array[:, :, 3]).resize(original.size, Image.Resampling.LANCZOS)
+    return cutout(np.asarray(original), np.asarray(alpha))
+
+def prepare_image(input_data, full_resolution):
+    """
+    Decode an upload into the RGB/RGBA array fed to the model
+    Returns (input_array, original) where original is the PIL image (capped
+    at MAX_DIMENSION) when full_resolution was requested and the upload was
+    downscaled for inference
+    """
+    with io.BytesIO(input_data) as input_stream:
+        img = Image.open(input_stream)
+        # Let libjpeg downscale JPEGs in the DCT domain (1/2, 1/4, 1/8)
+        # while decoding, the resizes below then only do the fine adjustment
+        target = MAX_DIMENSION if full_resolution else MAX_INFERENCE_DIMENSION
+        if img.format == 'JPEG' and max(img.size) > target:
+            # Pillow picks the scale from the tighter of the two axes, so ask
+            # for the fitted size rather than a square box, or wide and tall
+            # images would never be drafted
+            ratio = target / max(img.size)
+            img.draft('RGB', tuple(max(1, int(dim * ratio)) for dim in img.size))
+        
+        # Apply the EXIF orientation (as rembg's remove() did), so rotated
+        # phone photos are not returned sideways. Done after draft() since
+        # it loads the pixels, and in place to avoid an extra copy
+        ImageOps.exif_transpose(img, in_place=True)
+        
+        # Convert to RGB if necessary (handles RGBA, grayscale, etc.)
+        if img.mode not in ('RGB', 'RGBA'):
+            logger.info("Converting image from %s to RGB", img.mode)
+            img = img.convert('RGB')
+        
+        # Even full resolution results are capped, a 40MP RGBA result would
+        # not fit in the free tier's memory
+        if full_resolution and max(img.size) > MAX_DIMENSION:
+            logger.info("Image too large (%s), resizing to max %dpx", img.size, MAX_DIMENSION)
+            ratio = MAX_DIMENSION / max(img.size)
+            new_size = tuple(max(1, int(dim * ratio)) for dim in img.size)
+            resized = img.resize(new_size, Image.Resampling.LANCZOS)
+            img.close()
+            img = resized
+        
+        # Downscale to the model input size, the model resizes to
+        # 1024px internally anyway so extra pixels are wasted work
+        original = None
+        scale = min(1.0, MAX_INFERENCE_DIMENSION / max(img.size))
+        if scale < 1.0:
+            logger.info("Image larger than %dpx (%s), downscaling for inference", MAX_INFERENCE_DIMENSION, img.size)
+            new_size = tuple(max(1, int(dim * scale)) for dim in img.size)
+            small = img.resize(new_size, Image.Resampling.BILINEAR)
+            if full_resolution:
+                # Keep the original around to apply the upscaled mask to
+                img.load()
+                original = img
+            else:
+                img.close()
+            img = small
+            logger.info("Resized to %s", img.size)
+        
+        # Hand the model the decoded pixels directly instead of re-encoding
+        # them, so the upload is decoded exactly once
+        img.load()
+        input_array = np.asarray(img)
+        img.close()
+    
+    return input_array, original
+
+def finish_image(output_array, original=None):
+    """Restore full resolution if requested and encode the result"""
+    # Re-apply the mask at the original size if the client asked for it
+    if original is not None:
+        output_array = restore_full_resolution(original, output_array)
+        original.close()
+    
+    # Encode the result once, fast zlib level keeps latency down
+    return encode_png(output_array)
+
+def infer_image(input_array, original=None):
+    """Remove the background and return the encoded PNG result"""
+    return finish_image(process(input_array), original)
+
+def cache_key(input_data, full_resolution):
+    """Key a request by a hash of the upload and the output options"""
+    return hashlib.blake2b(input_data, digest_size=16).digest(), full_resolution
+
+def cache_get(key):
+    """Return the cached PNG for key, or None"""
+    with _response_cache_lock:
+        data = _response_cache.get(key)
+        if data is not None:
+            _response_cache.move_to_end(key)
+        return data
+
+def cache_put(key, data):
+    """Store a PNG result, evicting least recently used entries over budget"""
+    global _response_cache_bytes
+    
+    if len(data) > RESPONSE_CACHE_MAX_BYTES:
+        return
+    
+    with _response_cache_lock:
+        previous = _response_cache.pop(key, None)
+        if previous is not None:
+            _response_cache_bytes -= len(previous)
+        _response_cache[key] = data
+        _response_cache_bytes += len(data)
+        
+        while (len(_response_cache) > RESPONSE_CACHE_ENTRIES
+               or _response_cache_bytes > RESPONSE_CACHE_MAX_BYTES):
+            _, evicted = _response_cache.popitem(last=False)
+            _response_cache_bytes -= len(evicted)
+
+def binary_response(data, mimetype, filename):
+    """
+    Build an inline response around already-encoded bytes
+    Passes the body straight through to the WSGI server as a single write
+    """
+    response = app.response_class(data, mimetype=mimetype, direct_passthrough=True)
+    response.headers['Content-Length'] = str(len(data))
+    response.headers['Content-Disposition'] = f'inline; filename="{filename}"'
+    return response
+
+def png_response(data):
+    """Inline PNG response for a single result"""
+    return binary_response(data, 'image/png', 'removed_bg.png')
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
@@ -85,15 +449,42 @@ def validate_image_file(file):
     if not allowed_file(file.filename):
         return False, f"File type not allowed. Supported: {', '.join(ALLOWED_EXTENSIONS)}"
     
-    # Check file size
-    file.seek(0, os.SEEK_END)
-    file_size = file.tell()
-    file.seek(0)
+    # Size is enforced by MAX_CONTENT_LENGTH and read_upload()
+    return True, None
+
+def read_upload(file):
+    """
+    Read the uploaded file (already spooled by Werkzeug)
+    Returns the file contents, or None if it exceeds MAX_FILE_SIZE
+    """
+    # One spare byte lets us detect an upload that is over the limit
+    data = file.read(MAX_FILE_SIZE + 1)
+    if len(data) > MAX_FILE_SIZE:
+        return None
+    return data
+
+def model_unavailable_response():
+    """Load the model if needed; return an error response if it is unavailable"""
+    # Ensure model is loaded (lazy loading on first request)
+    if rembg_session is None:
+        logger.info("Model not loaded, initializing now...")
+        try:
+            ensure_model_loaded()
+        except Exception as e:
+            logger.error("Failed to load model: %s", e)
+            return jsonify({
+                "error": "Service initialization failed",
+                "message": "Could not load background removal model. Please try again."
+            }), 503
     
-    if file_size > MAX_FILE_SIZE:
-        return False, f"File too large. Maximum size: {MAX_FILE_SIZE / (1024*1024)}MB"
+    # Double check after loading attempt
+    if rembg_session is None:
+        return jsonify({
+            "error": "Service not ready",
+            "message": "Background removal model is not loaded"
+        }), 503
     
-    return True, None
+    return None
 
 @app.route('/', methods=['GET'])
 def home():
@@ -107,10 +498,21 @@ def home():
                 "description": "Remove background from image",
                 "accepts": "multipart/form-data",
                 "parameters": {
-                    "image": "Image file (PNG, JPG, JPEG, WEBP) - Max 10MB"
+                    "image": "Image file (PNG, JPG, JPEG, WEBP) - Max 10MB",
+                    "full": f"Optional query parameter. Set full=1 to return the original resolution, capped at {MAX_DIMENSION}px on the longest side; by default images are downscaled so the longest side is at most {MAX_INFERENCE_DIMENSION}px",
+                    "nocache": "Optional query parameter. Set nocache=1 to bypass the cache of recent results"
                 },
                 "returns": "PNG image with transparent background"
             },
+            "POST /api/remove-bg-batch": {
+                "description": "Remove background from several images in one batched model run",
+                "accepts": "multipart/form-data",
+                "parameters": {
+                    "image": f"Image files (repeat the field, up to {MAX_BATCH_FILES}) - combined size up to the single upload limit",
+                    "full": "Optional query parameter, as for /api/remove-bg"
+                },
+                "returns": "ZIP archive of PNG images with transparent background, in upload order"
+            },
             "GET /health": {
                 "description": "Health check endpoint",
                 "returns": "Service health status"
@@ -131,7 +533,7 @@ def health_check():
             "timestamp": datetime.utcnow().isoformat()
         }), 200
     except Exception as e:
-        logger.error(f"Health check failed: {str(e)}")
+        logger.error("Health check failed: %s", e)
         return jsonify({
             "status": "unhealthy",
             "error": str(e),
@@ -148,28 +550,16 @@ def remove_background():
     if request.method == 'OPTIONS':
         return '', 204
     
-    start_time = datetime.now()
-    logger.info(f"[{start_time.isoformat()}] New background removal request")
+    # perf_counter is far cheaper than datetime.now(); the log formatter
+    # already timestamps every record
+    start_time = time.perf_counter()
+    logger.info("New background removal request")
     
     try:
         # Ensure model is loaded (lazy loading on first request)
-        if rembg_session is None:
-            logger.info("Model not loaded, initializing now...")
-            try:
-                ensure_model_loaded()
-            except Exception as e:
-                logger.error(f"Failed to load model: {str(e)}")
-                return jsonify({
-                    "error": "Service initialization failed",
-                    "message": "Could not load background removal model. Please try again."
-                }), 503
-        
-        # Double check after loading attempt
-        if rembg_session is None:
-            return jsonify({
-                "error": "Service not ready",
-                "message": "Background removal model is not loaded"
-            }), 503
+        error_response = model_unavailable_response()
+        if error_response is not None:
+            return error_response
         
         # Validate request
         if 'image' not in request.files:
@@ -179,6 +569,7 @@ def remove_background():
             }), 400
         
         file = request.files['image']
+        full_resolution = request.args.get('full') == '1'
         
         # Validate file
         is_valid, error_message = validate_image_file(file)
@@ -188,103 +579,73 @@ def remove_background():
                 "message": error_message
             }), 400
         
-        logger.info(f"Processing image: {secure_filename(file.filename)}")
+        # Read image data into memory, bailing out early if it is too large
+        input_data = read_upload(file)
+        if input_data is None:
+            return request_entity_too_large(None)
+        logger.info(
+            "Processing image: %d bytes, ext=%s",
+            len(input_data),
+            file.filename.rsplit('.', 1)[-1][:8].lower()
+        )
         
-        # Read image data into memory
-        input_data = file.read()
-        input_size_mb = len(input_data) / (1024 * 1024)
-        logger.info(f"Input image size: {input_size_mb:.2f}MB")
+        # Serve repeated uploads from the response cache
+        use_cache = request.args.get('nocache') != '1'
+        if use_cache:
+            key = cache_key(input_data, full_resolution)
+            cached = cache_get(key)
+            if cached is not None:
+                logger.info("Returning cached result")
+                return png_response(cached)
         
-        # Open image with PIL for validation and potential conversion
+        # Decode and resize; the upload bytes and PIL images are only bound
+        # inside prepare_image, so they are freed as soon as it returns
         try:
-            img = Image.open(io.BytesIO(input_data))
-            original_mode = img.mode
-            original_size = img.size
-            needs_processing = False
-            
-            # Resize if image is very large (to save memory during processing)
-            MAX_DIMENSION = 2048  # Max width or height
-            if max(img.size) > MAX_DIMENSION:
-                logger.info(f"Image too large ({img.size}), resizing to max {MAX_DIMENSION}px")
-                ratio = MAX_DIMENSION / max(img.size)
-                new_size = tuple(int(dim * ratio) for dim in img.size)
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-                needs_processing = True
-                logger.info(f"Resized to {img.size}")
-            
-            # Convert to RGB if necessary (handles RGBA, grayscale, etc.)
-            if img.mode not in ('RGB', 'RGBA'):
-                logger.info(f"Converting image from {img.mode} to RGB")
-                img = img.convert('RGB')
-                needs_processing = True
-            
-            # Only re-save if we modified the image
-            if needs_processing or original_mode != img.mode:
-                # Convert back to bytes
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format='PNG', optimize=True)
-                img_byte_arr.seek(0)
-                # Free old data
-                del input_data
-                input_data = img_byte_arr.getvalue()
-                del img_byte_arr
-                logger.info(f"Processed image size: {len(input_data) / (1024 * 1024):.2f}MB")
-            
-            # Close image to free memory
-            img.close()
-            del img
-            
+            input_array, original = prepare_image(input_data, full_resolution)
+            del input_data
         except Exception as e:
-            logger.error(f"Failed to open/process image: {str(e)}")
+            logger.error("Failed to open/process image: %s", e)
             return jsonify({
                 "error": "Invalid image",
                 "message": "Could not process image file. Please ensure it's a valid image."
             }), 400
         
-        # Remove background using rembg
+        # Remove background
         logger.info("Removing background...")
         try:
-            output_data = remove(
-                input_data,
-                session=rembg_session,
-                post_process_mask=True  # Improves edge quality
-            )
+            output_data = infer_image(input_array, original)
             
             # Free input data immediately after processing
-            del input_data
+            del input_array, original
             
         except Exception as e:
-            logger.error(f"Background removal failed: {str(e)}")
+            logger.error("Background removal failed: %s", e)
             return jsonify({
                 "error": "Processing failed",
                 "message": "Failed to remove background. Image might be too large or corrupted."
             }), 500
         
-        # Create output image in memory
-        output_image = io.BytesIO(output_data)
-        output_image.seek(0)
+        if use_cache:
+            cache_put(key, output_data)
         
         # Log output size
-        output_size_mb = len(output_data) / (1024 * 1024)
-        logger.info(f"Output image size: {output_size_mb:.2f}MB")
+        logger.info("Output image size: %.2fMB", len(output_data) / (1024 * 1024))
         
-        # Calculate processing time
-        processing_time = (datetime.now() - start_time).total_seconds()
-        logger.info(f"Background removed successfully in {processing_time:.2f}s")
+        # Log processing time
+        logger.info("Background removed successfully in %.2fs", time.perf_counter() - start_time)
         
         # Force garbage collection to free memory
         gc.collect()
         
         # Return PNG with transparent background
-        return send_file(
-            output_image,
-            mimetype='image/png',
-            as_attachment=False,
-            download_name='removed_bg.png'
-        )
+        return png_response(output_data)
+    
+    except HTTPException:
+        # Let Flask's error handlers answer (e.g. 413 from MAX_CONTENT_LENGTH)
+        raise
     
     except Exception as e:
-        logger.error(f"Error processing request: {str(e)}", exc_info=True)
+        logger.error("Error processing request: %s", e, exc_info=True)
         # Force garbage collection even on error
         gc.collect()
         return jsonify({
@@ -292,6 +653,104 @@ def remove_background():
             "message": "An error occurred while processing your image. Please try again."
         }), 500
 
+@app.route('/api/remove-bg-batch', methods=['POST', 'OPTIONS'])
+def remove_background_batch():
+    """
+    Remove background from several uploaded images in one model run
+    Returns a ZIP archive with one PNG per image, in upload order
+    """
+    # Handle preflight CORS request
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    start_time = time.perf_counter()
+    logger.info("New batch background removal request")
+    
+    try:
+        error_response = model_unavailable_response()
+        if error_response is not None:
+            return error_response
+        
+        # Validate request
+        files = request.files.getlist('image')
+        if not files:
+            return jsonify({
+                "error": "Bad request",
+                "message": "No image file provided in request"
+            }), 400
+        
+        if len(files) > MAX_BATCH_FILES:
+            return jsonify({
+                "error": "Bad request",
+                "message": f"Too many images. Maximum per batch: {MAX_BATCH_FILES}"
+            }), 400
+        
+        full_resolution = request.args.get('full') == '1'
+        
+        input_arrays = []
+        originals = []
+        for index, file in enumerate(files):
+            is_valid, error_message = validate_image_file(file)
+            if not is_valid:
+                return jsonify({
+                    "error": "Invalid file",
+                    "message": f"Image {index + 1}: {error_message}"
+                }), 400
+            
+            input_data = read_upload(file)
+            if input_data is None:
+                return request_entity_too_large(None)
+            
+            try:
+                input_array, original = prepare_image(input_data, full_resolution)
+                del input_data
+            except Exception as e:
+                logger.error("Failed to open/process image %d: %s", index + 1, e)
+                return jsonify({
+                    "error": "Invalid image",
+                    "message": f"Could not process image {index + 1}. Please ensure it's a valid image."
+                }), 400
+            input_arrays.append(input_array)
+            originals.append(original)
+        
+        # Remove backgrounds in one batched model run
+        logger.info("Removing background from %d images...", len(input_arrays))
+        try:
+            output_arrays = process_many(input_arrays)
+            del input_arrays
+        except Exception as e:
+            logger.error("Batch background removal failed: %s", e)
+            return jsonify({
+                "error": "Processing failed",
+                "message": "Failed to remove background. Images might be too large or corrupted."
+            }), 500
+        
+        # PNGs are already compressed, store them as-is
+        with io.BytesIO() as archive:
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+                for index, (output_array, original) in enumerate(zip(output_arrays, originals), start=1):
+                    zf.writestr(f"removed_bg_{index}.png", finish_image(output_array, original))
+            del output_arrays, originals
+            output_data = archive.getvalue()
+        
+        logger.info("Batch of %d processed successfully in %.2fs", len(files), time.perf_counter() - start_time)
+        
+        gc.collect()
+        
+        return binary_response(output_data, 'application/zip', 'removed_bg.zip')
+    
+    except HTTPException:
+        # Let Flask's error handlers answer (e.g. 413 from MAX_CONTENT_LENGTH)
+        raise
+    
+    except Exception as e:
+        logger.error("Error processing batch request: %s", e, exc_info=True)
+        gc.collect()
+        return jsonify({
+            "error": "Internal server error",
+            "message": "An error occurred while processing your images. Please try again."
+        }), 500
+
 @app.errorhandler(413)
 def request_entity_too_large(error):
     """Handle file too large error"""
@@ -303,7 +762,7 @@ def request_entity_too_large(error):
 @app.errorhandler(500)
 def internal_server_error(error):
     """Handle internal server errors"""
-    logger.error(f"Internal server error: {str(error)}")
+    logger.error("Internal server error: %s", error)
     return jsonify({
         "error": "Internal server error",
         "message": "An unexpected error occurred"
@@ -0,0 +1,213 @@
+"""
+Offline model build step for the Background Removal Service
+Exports rembg's isnet-general-use weights to ONNX, slims the graph, quantizes
+it to INT8 (and converts it to FP16), then runs ONNX Runtime's
+hardware-independent graph optimizations offline so the service loads
+pre-fused *.opt.onnx models
+
+Run once at build time (see render.yaml):
+    python build_model.py
+"""
+
+import os
+import shutil
+import logging
+
+import numpy as np
+import onnx
+import onnxruntime as ort
+import onnxslim
+from PIL import Image
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from onnxruntime.transformers.float16 import convert_float_to_float16
+from rembg import new_session
+
+from mask_postprocess import open_and_smooth
+from ort_session import preprocess
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.environ.get('MODEL_DIR', os.path.join(BASE_DIR, 'models'))
+CALIBRATION_DIR = os.environ.get('CALIBRATION_DIR', os.path.join(BASE_DIR, 'calibration'))
+CALIBRATION_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+FP32_MODEL = os.path.join(MODEL_DIR, 'isnet.onnx')
+DYNAMIC_MODEL = os.path.join(MODEL_DIR, 'isnet.dynamic.onnx')
+SLIM_MODEL = os.path.join(MODEL_DIR, 'isnet.slim.onnx')
+PREPROCESSED_MODEL = os.path.join(MODEL_DIR, 'isnet.pre.onnx')
+INT8_MODEL = os.path.join(MODEL_DIR, 'isnet_int8.onnx')
+FP16_MODEL = os.path.join(MODEL_DIR, 'isnet_fp16.onnx')
+
+
+class ImageCalibrationReader(CalibrationDataReader):
+    """Feeds representative images to the static quantizer"""
+
+    def __init__(self, image_paths, input_name):
+        self.input_name = input_name
+        self.image_paths = iter(image_paths)
+
+    def get_next(self):
+        path = next(self.image_paths, None)
+        if path is None:
+            return None
+        with Image.open(path) as img:
+            return {self.input_name: preprocess(img)}
+
+
+def export_fp32():
+    """Copy rembg's isnet-general-use ONNX graph into the model directory"""
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    logger.info("Fetching isnet-general-use weights via rembg...")
+    session = new_session("isnet-general-use")
+    source_path = type(session).download_models()
+    input_name = session.inner_session.get_inputs()[0].name
+    del session
+
+    shutil.copyfile(source_path, FP32_MODEL)
+    logger.info(f"Exported fp32 model to {FP32_MODEL}")
+    return input_name
+
+
+def make_batch_dynamic(input_name):
+    """
+    Give the fp32 graph a symbolic batch dimension so requests can be batched
+    Kept only if a batch of two actually runs; some exports bake batch=1 into
+    internal reshapes, in which case the service runs items one at a time
+    """
+    model = onnx.load(FP32_MODEL)
+    for value in list(model.graph.input) + list(model.graph.output):
+        dims = value.type.tensor_type.shape.dim
+        if dims:
+            dims[0].dim_param = 'batch'
+    # Stale intermediate shapes would still claim batch=1
+    del model.graph.value_info[:]
+    onnx.save(model, DYNAMIC_MODEL)
+    del model
+
+    try:
+        session = ort.InferenceSession(DYNAMIC_MODEL, providers=["CPUExecutionProvider"])
+        session.run(None, {input_name: np.zeros((2, 3, 1024, 1024), dtype=np.float32)})
+        del session
+    except Exception as e:
+        logger.warning(f"Graph does not support batching, keeping batch=1: {str(e)}")
+        os.remove(DYNAMIC_MODEL)
+        return
+
+    os.replace(DYNAMIC_MODEL, FP32_MODEL)
+    logger.info("Batch dimension made dynamic")
+
+
+def slim_model():
+    """Fold redundant Transpose/Cast/Reshape nodes out of the fp32 graph"""
+    logger.info("Slimming fp32 graph with onnxslim...")
+    onnxslim.slim(FP32_MODEL, SLIM_MODEL)
+    logger.info(f"Slimmed model written to {SLIM_MODEL}")
+
+
+def optimized_path(model_path):
+    """isnet_int8.onnx -> isnet_int8.opt.onnx (isnet.slim.onnx -> isnet.opt.onnx)"""
+    stem = model_path[:-len('.onnx')]
+    if stem.endswith('.slim'):
+        stem = stem[:-len('.slim')]
+    return f"{stem}.opt.onnx"
+
+
+def optimize_offline(model_path):
+    """
+    Run ORT_ENABLE_EXTENDED graph optimization once and save the result
+    Stops short of ORT_ENABLE_ALL: its NCHWc layout transforms are specific
+    to the build host's CPU, so the service applies them at load time
+    """
+    output_path = optimized_path(model_path)
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    so.optimized_model_filepath = output_path
+    ort.InferenceSession(model_path, so, providers=["CPUExecutionProvider"])
+    logger.info(f"Optimized model written to {output_path}")
+
+
+def calibration_images():
+    """List calibration images, empty if the directory is missing"""
+    if not os.path.isdir(CALIBRATION_DIR):
+        return []
+    return sorted(
+        os.path.join(CALIBRATION_DIR, name)
+        for name in os.listdir(CALIBRATION_DIR)
+        if name.lower().endswith(CALIBRATION_EXTENSIONS)
+    )
+
+
+def quantize_int8(input_name, images):
+    """Statically quantize the fp32 graph to INT8 (QDQ, per-channel weights)"""
+    logger.info(f"Quantizing to INT8 with {len(images)} calibration images...")
+    quant_pre_process(SLIM_MODEL, PREPROCESSED_MODEL)
+    quantize_static(
+        PREPROCESSED_MODEL,
+        INT8_MODEL,
+        ImageCalibrationReader(images, input_name),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        # By default MinMax keeps every intermediate tensor of every image
+        # in memory, several GB per 1024x1024 image for ISNet
+        extra_options={'CalibMaxIntermediateOutputs': 1},
+    )
+    os.remove(PREPROCESSED_MODEL)
+    logger.info(f"Quantized model written to {INT8_MODEL}")
+
+
+def convert_fp16():
+    """
+    Convert the slimmed fp32 graph to FP16, inputs and outputs included
+    Fallback for when INT8 loses too much edge detail (select it with
+    ISNET_MODEL=isnet_fp16.opt.onnx)
+    """
+    logger.info("Converting to FP16...")
+    model = convert_float_to_float16(onnx.load(SLIM_MODEL), keep_io_types=False)
+    onnx.save(model, FP16_MODEL)
+    logger.info(f"FP16 model written to {FP16_MODEL}")
+
+
+def warm_numba_cache():
+    """
+    Compile the mask post-processing kernels now so their on-disk cache
+    (cache=True) is ready, keeping the compile out of worker startup
+    """
+    logger.info("Compiling mask post-processing kernels...")
+    mask = np.zeros((64, 64), dtype=np.uint8)
+    mask[16:48, 16:48] = 255
+    open_and_smooth(mask, radius=2)
+    logger.info("Numba cache populated")
+
+
+if __name__ == '__main__':
+    input_name = export_fp32()
+    make_batch_dynamic(input_name)
+    slim_model()
+    images = calibration_images()
+    if images:
+        quantize_int8(input_name, images)
+    else:
+        # The service falls back to isnet.opt.onnx (see MODEL_CANDIDATES)
+        logger.warning(
+            f"No calibration images found in {CALIBRATION_DIR}, skipping INT8. Add a "
+            f"handful of representative {', '.join(CALIBRATION_EXTENSIONS)} images "
+            "(or point CALIBRATION_DIR at them) to build the INT8 model."
+        )
+    convert_fp16()
+    for path in (SLIM_MODEL, INT8_MODEL, FP16_MODEL):
+        if os.path.exists(path):
+            optimize_offline(path)
+    warm_numba_cache()
@@ -13,14 +13,23 @@ backlog = 2048
 # Worker processes
 # Use 1 worker for free tier to minimize memory usage
 workers = 1
-worker_class = 'sync'
+# Threads share the single model copy and overlap decoding with inference,
+# since ONNX Runtime releases the GIL inside its kernels. Avoid gevent: the
+# native ORT calls cannot be monkey-patched and would block the event loop
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
 worker_connections = 1000
 timeout = 120  # Increased timeout for image processing
 keepalive = 5
 
-# Preload app to load model once for all workers
+# Preload the app code in the master; the model itself loads per worker in
+# post_worker_init, since ONNX Runtime sessions do not survive fork()
 preload_app = True
 
+# Limit glibc malloc arenas so gthread workers do not fragment RSS across
+# per-thread arenas (also set in render.yaml, since glibc reads it at exec)
+raw_env = ['MALLOC_ARENA_MAX=2']
+
 # Logging
 accesslog = '-'
 errorlog = '-'
@@ -45,6 +54,13 @@ def on_starting(server):
     print("=" * 60)
     print("Starting Background Removal API Server")
     print("=" * 60)
+    
+    # Verify which Pillow build is installed; pillow-simd versions carry a
+    # .postN suffix, stock Pillow falls back to SSE/scalar paths
+    import PIL
+    from PIL import features
+    build = "pillow-simd" if ".post" in PIL.__version__ else "stock Pillow (no AVX2)"
+    print(f"Pillow {PIL.__version__}: {build}, libjpeg-turbo: {features.check_feature('libjpeg_turbo')}")
 
 def on_reload(server):
     """Called to recycle workers during a reload via SIGHUP."""
@@ -53,7 +69,7 @@ def on_reload(server):
 def when_ready(server):
     """Called just after the server is started."""
     print(f"Server is ready. Listening on {bind}")
-    print(f"Workers: {workers}")
+    print(f"Workers: {workers} ({worker_class}, {threads} threads)")
     print(f"Timeout: {timeout}s")
 
 def pre_fork(server, worker):
@@ -64,6 +80,18 @@ def post_fork(server, worker):
     """Called just after a worker has been forked."""
     print(f"Worker {worker.pid} spawned")
 
+def post_worker_init(worker):
+    """Called just after a worker has initialized the application."""
+    # Load and warm the model before the worker accepts traffic. This runs
+    # per worker rather than in the preloading master because ONNX Runtime
+    # thread pools do not survive fork()
+    from app import init_model
+    try:
+        init_model()
+    except Exception as e:
+        # Requests will retry the lazy load in remove_background
+        print(f"Worker {worker.pid} could not preload model: {e}")
+
 def pre_exec(server):
     """Called just before a new master process is forked."""
     print("Forking new master process...")
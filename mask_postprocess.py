@@ -0,0 +1,94 @@
+"""
+Parallel mask post-processing for the Background Removal Service
+Numba replacement for rembg's post_process(): morphological cleanup and
+smoothing on uint8 masks, parallelized across rows
+"""
+
+import threading
+
+import numba
+import numpy as np
+from numba import njit, prange
+
+# The kernels are parallel already; running them from several gthread
+# request threads at once would abort the process under Numba's default
+# workqueue threading layer, so calls are serialized
+_kernel_lock = threading.Lock()
+_num_threads = None
+
+
+def set_threads(num_threads):
+    """Cap the threads the kernels use, e.g. to the container's CPU quota"""
+    global _num_threads
+    _num_threads = max(1, min(num_threads, numba.config.NUMBA_NUM_THREADS))
+
+
+@njit(parallel=True, cache=True, boundscheck=False)
+def _morph3x3(src, dst, dilate):
+    """
+    3x3 dilation (max) or erosion (min) of src into dst with the cross-shaped
+    element OpenCV's 3x3 MORPH_ELLIPSE gives (no corner taps)
+    """
+    height, width = src.shape
+    for y in prange(height):
+        y0 = max(y - 1, 0)
+        y1 = min(y + 1, height - 1)
+        for x in range(width):
+            x0 = max(x - 1, 0)
+            x1 = min(x + 1, width - 1)
+            up = src[y0, x]
+            down = src[y1, x]
+            left = src[y, x0]
+            right = src[y, x1]
+            value = src[y, x]
+            if dilate:
+                value = max(value, up, down, left, right)
+            else:
+                value = min(value, up, down, left, right)
+            dst[y, x] = value
+
+
+@njit(parallel=True, cache=True, boundscheck=False)
+def _box_threshold(mask, radius):
+    """Box blur mask in place via a summed-area table, then binarize at 127"""
+    height, width = mask.shape
+    # int64 rather than uint16: sums over a full mask overflow 16 bits
+    sat = np.zeros((height + 1, width + 1), dtype=np.int64)
+    for y in prange(height):
+        acc = 0
+        for x in range(width):
+            acc += mask[y, x]
+            sat[y + 1, x + 1] = acc
+    for x in prange(1, width + 1):
+        for y in range(2, height + 1):
+            sat[y, x] += sat[y - 1, x]
+
+    for y in prange(height):
+        ya = max(y - radius, 0)
+        yb = min(y + radius + 1, height)
+        for x in range(width):
+            xa = max(x - radius, 0)
+            xb = min(x + radius + 1, width)
+            total = sat[yb, xb] - sat[ya, xb] - sat[yb, xa] + sat[ya, xa]
+            count = (yb - ya) * (xb - xa)
+            mask[y, x] = 255 if total >= 127 * count else 0
+
+
+def open_and_smooth(mask, radius=2):
+    """
+    Clean up a uint8 mask the way rembg's post_process() does: 3x3
+    morphological open (erode, then dilate, with the cross that rembg's 3x3
+    MORPH_ELLIPSE yields) to drop background specks, then
+    smoothing and a threshold at 127. rembg smooths with a 5x5 Gaussian
+    (sigma 2); this uses a (2 * radius + 1) box blur instead
+    The mask is modified in place (it must be writable) and returned
+    """
+    scratch = np.empty_like(mask)
+    with _kernel_lock:
+        # Numba's thread count is per calling thread, so apply it every time
+        if _num_threads is not None:
+            numba.set_num_threads(_num_threads)
+        _morph3x3(mask, scratch, False)
+        _morph3x3(scratch, mask, True)
+        _box_threshold(mask, radius)
+    return mask
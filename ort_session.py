@@ -0,0 +1,186 @@
+"""
+ONNX Runtime session for the ISNet background removal model
+Loads a locally exported (and optionally quantized) graph instead of rembg's
+downloaded default, while staying compatible with rembg's remove()
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+import onnxruntime as ort
+from PIL import Image
+
+# ISNet (isnet-general-use) input geometry and normalization
+MODEL_INPUT_SIZE = (1024, 1024)
+MODEL_MEAN = (0.5, 0.5, 0.5)
+MODEL_STD = (1.0, 1.0, 1.0)
+
+
+def preprocess(img):
+    """Convert a PIL image into the (1, 3, H, W) float32 tensor ISNet expects"""
+    im = img.convert('RGB').resize(MODEL_INPUT_SIZE, Image.Resampling.LANCZOS)
+    im_ary = np.asarray(im, dtype=np.float32)
+    im_ary = im_ary / max(float(im_ary.max()), 1.0)
+    im_ary = (im_ary - np.asarray(MODEL_MEAN, dtype=np.float32)) / np.asarray(MODEL_STD, dtype=np.float32)
+    return np.expand_dims(im_ary.transpose((2, 0, 1)), 0).astype(np.float32)
+
+
+def postprocess(pred, size):
+    """Turn a raw ISNet prediction into an L-mode mask of the given size"""
+    pred = np.squeeze(pred[:, 0, :, :]).astype(np.float32)
+    ma = pred.max()
+    mi = pred.min()
+    pred = (pred - mi) / max(ma - mi, 1e-8)
+    mask = Image.fromarray((pred * 255).astype(np.uint8), mode='L')
+    return mask.resize(size, Image.Resampling.LANCZOS)
+
+
+class ORTSession:
+    """
+    Thin wrapper around onnxruntime.InferenceSession
+    Exposes the predict() interface rembg's remove() calls on its sessions
+    """
+
+    def __init__(self, model_path, sess_options=None):
+        self.model_name = model_path
+        self.inner_session = ort.InferenceSession(
+            model_path,
+            sess_options,
+            providers=["CPUExecutionProvider"]
+        )
+        model_input = self.inner_session.get_inputs()[0]
+        self.input_name = model_input.name
+        # ISNet has several side outputs, only the first one is the mask
+        self.output_name = self.inner_session.get_outputs()[0].name
+        # A fixed leading dimension means the graph was exported for that
+        # batch size only; a symbolic one accepts any batch
+        batch_dim = model_input.shape[0]
+        self.max_batch_size = batch_dim if isinstance(batch_dim, int) else None
+        # FP16 graphs take half-precision input directly
+        self.input_dtype = np.float16 if model_input.type == 'tensor(float16)' else np.float32
+        self._buffers = threading.local()
+
+    def _input_buffer(self, batch_size):
+        """Per-thread model input buffer, reused across runs and grown on demand"""
+        buffer = getattr(self._buffers, 'input', None)
+        if buffer is None or buffer.shape[0] < batch_size:
+            buffer = np.empty((batch_size, 3) + MODEL_INPUT_SIZE[::-1], dtype=self.input_dtype)
+            self._buffers.input = buffer
+        return buffer[:batch_size]
+
+    def run(self, tensors):
+        """Run the model on a list of (1, 3, H, W) tensors, returning (N, 1, H, W) predictions"""
+        batch = self._input_buffer(len(tensors))
+        for i, tensor in enumerate(tensors):
+            batch[i] = tensor[0]  # Casts to the model's input precision
+
+        # Bind the reused buffer in place so ORT neither copies nor casts it
+        binding = self.inner_session.io_binding()
+        binding.bind_cpu_input(self.input_name, batch)
+        binding.bind_output(self.output_name, 'cpu')
+        self.inner_session.run_with_iobinding(binding)
+        return binding.get_outputs()[0].numpy()
+
+    def predict(self, img, *args, **kwargs):
+        """Return a list with a single mask for the given PIL image"""
+        return [postprocess(self.run([preprocess(img)]), img.size)]
+
+
+class _BatchItem:
+    """One queued inference request and the slot its result lands in"""
+
+    __slots__ = ('tensor', 'done', 'result', 'error')
+
+    def __init__(self, tensor):
+        self.tensor = tensor
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent predictions into batched ORTSession runs
+    Request threads preprocess their own images and queue the tensors; a
+    single background thread drains up to max_batch_size of them (waiting at
+    most max_wait seconds for stragglers) into one session.run call
+    """
+
+    def __init__(self, session, max_batch_size=1, max_wait=0.02):
+        self.session = session
+        self.model_name = session.model_name
+        if session.max_batch_size is not None:
+            max_batch_size = min(max_batch_size, session.max_batch_size)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name='ort-batcher', daemon=True)
+        self.worker.start()
+
+    def predict_many(self, imgs):
+        """Return one mask per PIL image, batched with any concurrent callers"""
+        items = [_BatchItem(preprocess(img)) for img in imgs]
+        for item in items:
+            self.queue.put(item)
+
+        masks = []
+        for img, item in zip(imgs, items):
+            item.done.wait()
+            if item.error is not None:
+                raise item.error
+            masks.append(postprocess(item.result, img.size))
+        return masks
+
+    def predict(self, img, *args, **kwargs):
+        """rembg-compatible single image prediction"""
+        return self.predict_many([img])
+
+    def close(self):
+        """Stop the background thread once already queued items are done"""
+        self.queue.put(None)
+
+    def _collect(self):
+        """Block for one item, then gather more until the batch or window is full"""
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Closing: finish this batch, then stop
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                if self.max_batch_size > 1:
+                    preds = self.session.run([item.tensor for item in batch])
+                    for i, item in enumerate(batch):
+                        item.result = preds[i:i + 1]
+                else:
+                    # Graph has a fixed batch of 1, run items back to back
+                    for item in batch:
+                        item.result = self.session.run([item.tensor])
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+            finally:
+                for item in batch:
+                    item.tensor = None
+                    item.done.set()